@@ -24,32 +24,29 @@ def connect(zmq_context, url):
     sub_sock.connect(url)
     sub_sock.setsockopt(zmq.SUBSCRIBE, b'')
 
-    metadata = None
-
     while True:
         mask = sub_sock.poll(flags=zmq.POLLIN)
         if mask == 0:
             continue
         
-        tag, idx, data = sub_sock.recv_multipart()
+        tag, idx, metadata, data = sub_sock.recv_multipart()
+        if tag != PubSubCommands.FRAME:
+            continue
 
-        idx = int(idx.decode('utf-8'))
+        idx = int.from_bytes(idx, 'little')
+        image_id = f'img-{idx:04d}'
 
-        if tag == PubSubCommands.METADATA:
-            metadata = json.loads(data.decode('utf-8'))
+        metadata = json.loads(metadata.decode('utf-8'))
+        
+        jpeg = io.BytesIO(data)
+        image = np.array(Image.open(jpeg))
         
-        elif metadata is not None and tag == PubSubCommands.JPEGIMG:
-            image_id = f'img-{idx:04d}'
-            
-            jpeg = io.BytesIO(data)
-            image = np.array(Image.open(jpeg))
-            
-            item = {
-                'idx': idx,
-                'image': image,
-                'metadata': metadata
-            }
-            yield item
+        item = {
+            'idx': idx,
+            'image': image,
+            'metadata': metadata
+        }
+        yield item
     
     sub_sock.disconnect(self.pub_url)
 
@@ -96,31 +96,32 @@ class Worker(QThread):
             self._holding = False
     
     def _handle_sub(self):
-            tag, idx, data = self.sub_sock.recv_multipart()
+            tag, idx, metadata, data = self.sub_sock.recv_multipart()
             
             # if we're paused, receive the message but do nothing with it
             if self._paused or self._holding:
                 return
 
             # not paused, so handle the message
-            idx = int(idx.decode('utf-8'))
+            if tag != PubSubCommands.FRAME:
+                return
+            
+            idx = int.from_bytes(idx, 'little')
 
-            if tag == PubSubCommands.METADATA:
-                metadata = data.decode('utf-8')
-                self.update_metadata.emit(idx, metadata)
+            metadata = metadata.decode('utf-8')
+            self.update_metadata.emit(idx, metadata)
             
-            elif tag == PubSubCommands.JPEGIMG:
-                # only send one image at a time so as not to overwhelm the UI thread
-                #   with events. the UI thread sends the resume message when it is done.
-                self._holding = True
+            # only send one image at a time so as not to overwhelm the UI thread
+            #   with events. the UI thread sends the resume message when it is done.
+            self._holding = True
 
-                image_id = f'img-{idx:04d}'
+            image_id = f'img-{idx:04d}'
+        
+            jpeg = io.BytesIO(data)
+            image = np.array(Image.open(jpeg))
             
-                jpeg = io.BytesIO(data)
-                image = np.array(Image.open(jpeg))
-                
-                # and send it to the GUI thread
-                self.update_image.emit(idx, image)
+            # and send it to the GUI thread
+            self.update_image.emit(idx, image)
 
     def set_over(self):
         self.sender.send_multipart([self.over_msg, b'', b''])
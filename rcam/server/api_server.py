@@ -2,7 +2,8 @@ import time
 import threading
 import zmq
 
-from .commands import ApiCommands
+from .commands import ApiCommands, ServerUpdates
+from . import codec
 
 
 class ApiServer(threading.Thread):
@@ -76,37 +77,44 @@ class ApiServer(threading.Thread):
         self.api_handlers[cmd](body)
     
     def handle_svr_sock(self):
-        updates = self.svr_sock.recv_pyobj()
-        self.exposure_time = updates.get('ExposureTime', self.exposure_time)
-        self.analogue_gain = updates.get('AnalogueGain', self.analogue_gain)
-        self.lens_position = updates.get('LensPosition', self.lens_position)
-        self.red_gain = updates.get('RedGain', self.red_gain)
-        self.blue_gain = updates.get('BlueGain', self.blue_gain)
+        updates = self.svr_sock.recv()
+        mask, ag, et, lp, rg, bg = ServerUpdates.STRUCT.unpack(updates)
+        
+        if mask & ServerUpdates.EXPOSURE_TIME:
+            self.exposure_time = int(et)
+        if mask & ServerUpdates.ANALOGUE_GAIN:
+            self.analogue_gain = ag
+        if mask & ServerUpdates.LENS_POSITION:
+            self.lens_position = lp
+        if mask & ServerUpdates.RED_GAIN:
+            self.red_gain = rg
+        if mask & ServerUpdates.BLUE_GAIN:
+            self.blue_gain = bg
 
     def handle_shutdown(self, body):
         controls = {
             'Over': True
         }
-        self.svr_sock.send_pyobj(controls)
+        self.svr_sock.send(codec.dumps(controls))
         self.over = True
         
     def handle_af_enable(self, body):
         controls = {
             'AfEnable': True
         }
-        self.svr_sock.send_pyobj(controls)
+        self.svr_sock.send(codec.dumps(controls))
     
     def handle_af_disable(self, body):
         controls = {
             'AfEnable': False
         }
-        self.svr_sock.send_pyobj(controls)
+        self.svr_sock.send(codec.dumps(controls))
 
     def handle_af_run(self, body):
         controls = {
             'AfTrigger': True
         }
-        self.svr_sock.send_pyobj(controls)
+        self.svr_sock.send(codec.dumps(controls))
 
     def handle_lp_increase(self, body):
         if self.lens_position is None:
@@ -115,7 +123,7 @@ class ApiServer(threading.Thread):
         controls = {
             'LensPosition': self.lens_position*1.1
         }
-        self.svr_sock.send_pyobj(controls)
+        self.svr_sock.send(codec.dumps(controls))
 
     def handle_lp_decrease(self, body):
         if self.lens_position is None:
@@ -124,20 +132,20 @@ class ApiServer(threading.Thread):
         controls = {
             'LensPosition': self.lens_position*0.9
         }
-        self.svr_sock.send_pyobj(controls)
+        self.svr_sock.send(codec.dumps(controls))
 
     def handle_ae_enable(self, body):
         controls = {
             'AeEnable': True
         }
-        self.svr_sock.send_pyobj(controls)
+        self.svr_sock.send(codec.dumps(controls))
     
     def handle_ae_disable(self, body):
         controls = {
             'AeEnable': False,
             'AwbEnable': False
         }
-        self.svr_sock.send_pyobj(controls)
+        self.svr_sock.send(codec.dumps(controls))
         
     def handle_ag_increase(self, body):
         self.scale_exposure(ApiCommands.ANALOGUE_GAIN_INCREASE, body)
@@ -185,26 +193,26 @@ class ApiServer(threading.Thread):
             'AnalogueGain': self.analogue_gain,
             'ExposureTime': self.exposure_time,
         }
-        self.svr_sock.send_pyobj(controls)
+        self.svr_sock.send(codec.dumps(controls))
 
 
         if self.lens_position is not None:
             controls = {
                 'LensPosition': self.lens_position*0.9
             }
-            self.svr_sock.send_pyobj(controls)
+            self.svr_sock.send(codec.dumps(controls))
 
     def handle_awb_enable(self, body):
         controls = {
             'AwbEnable': True
         }
-        self.svr_sock.send_pyobj(controls)
+        self.svr_sock.send(codec.dumps(controls))
 
     def handle_awb_disable(self, body):
         controls = {
             'AwbEnable': False
         }
-        self.svr_sock.send_pyobj(controls)
+        self.svr_sock.send(codec.dumps(controls))
 
     def handle_rg_increase(self, body):
         if self.red_gain is None:
@@ -214,7 +222,7 @@ class ApiServer(threading.Thread):
             'AwbEnable': False,
             'ColourGains': (self.red_gain*1.1, self.blue_gain)
         }
-        self.svr_sock.send_pyobj(controls)
+        self.svr_sock.send(codec.dumps(controls))
 
     def handle_rg_decrease(self, body):
         if self.red_gain is None:
@@ -223,7 +231,7 @@ class ApiServer(threading.Thread):
             'AwbEnable': False,
             'ColourGains': (self.red_gain*0.9, self.blue_gain)
         }
-        self.svr_sock.send_pyobj(controls)
+        self.svr_sock.send(codec.dumps(controls))
 
     def handle_bg_increase(self, body):
         if self.blue_gain is None:
@@ -232,7 +240,7 @@ class ApiServer(threading.Thread):
             'AwbEnable': False,
             'ColourGains': (self.red_gain, self.blue_gain*1.1)
         }
-        self.svr_sock.send_pyobj(controls)
+        self.svr_sock.send(codec.dumps(controls))
 
     def handle_bg_decrease(self, body):
         if self.blue_gain is None:
@@ -241,7 +249,7 @@ class ApiServer(threading.Thread):
             'AwbEnable': False,
             'ColourGains': (self.red_gain, self.blue_gain*0.9)
         }
-        self.svr_sock.send_pyobj(controls)
+        self.svr_sock.send(codec.dumps(controls))
 
     def handle_set_size(self, body):
         body = body.decode('utf-8')
@@ -250,22 +258,22 @@ class ApiServer(threading.Thread):
             'Width': width,
             'Height': height
         }
-        self.svr_sock.send_pyobj(controls)
+        self.svr_sock.send(codec.dumps(controls))
     
     def handle_fit_none(self, body):
         controls = {
             'FitMode': 'none'
         }
-        self.svr_sock.send_pyobj(controls)
+        self.svr_sock.send(codec.dumps(controls))
     
     def handle_fit_scaled(self, body):
         controls = {
             'FitMode': 'scaled'
         }
-        self.svr_sock.send_pyobj(controls)
+        self.svr_sock.send(codec.dumps(controls))
 
     def handle_fit_cropped(self, body):
         controls = {
             'FitMode': 'cropped'
         }
-        self.svr_sock.send_pyobj(controls)
+        self.svr_sock.send(codec.dumps(controls))
@@ -0,0 +1,16 @@
+# orjson is much faster than the standard library; fall back if not installed
+try:
+    import orjson
+
+    def dumps(obj):
+        return orjson.dumps(obj, option=orjson.OPT_SERIALIZE_NUMPY)
+
+    loads = orjson.loads
+
+except ImportError:
+    import json
+
+    def dumps(obj):
+        return json.dumps(obj, separators=(',',':')).encode('utf-8')
+
+    loads = json.loads
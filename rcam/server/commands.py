@@ -1,3 +1,6 @@
+import struct
+
+
 
 
 class ApiCommands:
@@ -41,4 +44,16 @@ class PubSubCommands:
     METADATA = "metadata".encode('utf-8')
     JPEGIMG  = "jpeg".encode('utf-8')
     RGBIMG   = "rgb".encode('utf-8')
+    FRAME    = "frame".encode('utf-8')
 
+
+class ServerUpdates:
+    # bits in the mask marking which values are present
+    ANALOGUE_GAIN = 0x01
+    EXPOSURE_TIME = 0x02
+    LENS_POSITION = 0x04
+    RED_GAIN      = 0x08
+    BLUE_GAIN     = 0x10
+    
+    # mask, analogue gain, exposure time, lens position, red gain, blue gain
+    STRUCT = struct.Struct('<Bddddd')
@@ -1,7 +1,9 @@
 from itertools import count
-import json
 import sys
 import io
+import types
+import queue
+import threading
 import zmq
 
 from PIL import Image
@@ -9,10 +11,20 @@ import numpy as np
 
 try:
     from libcamera import controls
+    _AF_AUTO = controls.AfModeEnum.Auto
+    _AF_MANUAL = controls.AfModeEnum.Manual
+    _AF_START = controls.AfTriggerEnum.Start
 except:
     pass
 
-from .commands import PubSubCommands
+# libjpeg-turbo bindings are much faster than PIL; fall back if not installed
+try:
+    import simplejpeg
+except ImportError:
+    simplejpeg = None
+
+from .commands import PubSubCommands, ServerUpdates
+from . import codec
 
 
 image_dtypes = {
@@ -26,25 +38,93 @@ image_dtypes = {
     'SRGGB16': np.uint16,
 }
 
+# the metadata published with each frame; everything else, including the
+#   large stats outputs, stays on the server
+_PUBLISH_KEYS = (
+    'AeEnable',
+    'AeLocked',
+    'AfEnable',
+    'AfState',
+    'AnalogueGain',
+    'AwbEnable',
+    'CameraModel',
+    'ColourGains',
+    'ColourTemperature',
+    'DigitalGain',
+    'ExposureTime',
+    'FrameDuration',
+    'ImageSize',
+    'LensPosition',
+    'Lux',
+    'SensorBlackLevels',
+    'SensorTimestamp',
+)
+
+# the whitebalance and exposure controls, passed unchanged to the camera
+_CAMERA_KEYS = ('AwbEnable', 'ColourGains', 'AeEnable', 'AnalogueGain', 'ExposureTime')
+
+_SENTINEL = object()
+
+
+class Frame:
+    __slots__ = ('idx', 'controls', 'metadata', 'main', 'raw', 'jpeg')
+    
+    def __init__(self, idx):
+        self.idx = idx
+        self.controls = {}
+        self.metadata = None
+        self.main = None
+        self.raw = None
+        self.jpeg = None
+    
+    # the stream that gets encoded: raw if it was captured, otherwise main.
+    #   each stream is held as an (image, stream_info) tuple
+    @property
+    def stream(self):
+        return self.main if self.raw is None else self.raw
+    
+    @stream.setter
+    def stream(self, value):
+        if self.raw is None:
+            self.main = value
+        else:
+            self.raw = value
+
 
 def control(svr_socket):
     
     for idx in count():
-        item = {
-            'idx': idx,
-            'controls': {}
-        }
-        while True:
-            ev = svr_socket.poll(timeout=0, flags=zmq.POLLIN)
-            if ev == 0:
-                break
-            ctrls = svr_socket.recv_pyobj()
-            item['controls'].update(ctrls)
+        item = Frame(idx)
+        # drain all pending control messages
+        try:
+            while True:
+                buf = svr_socket.recv(flags=zmq.NOBLOCK, copy=False)
+                item.controls.update(codec.loads(buf.bytes))
+        except zmq.Again:
+            pass
 
         yield item
 
 
 def capture(pipe, camera, arrays):
+    # the stream configuration doesn't change while capturing, so look it up
+    #   once and share it between all the frames
+    array_info = []
+    for array in arrays:
+        config = camera.camera_config[array]
+        stream_info = types.SimpleNamespace(
+            format=config['format'],
+            framesize=config['framesize'],
+            size=config['size'],
+            stride=config['stride']
+        )
+        array_info.append((array, image_dtypes[config['format']], stream_info))
+    
+    camera_model = camera.camera_properties['Model']
+    
+    image_key = 'raw' if 'raw' in arrays else 'main'
+    image_size = camera.camera_config[image_key]['size']
+    
     # get the camera capturing
     job = camera.capture_arrays(arrays, wait=False)    
 
@@ -55,28 +135,22 @@ def capture(pipe, camera, arrays):
         job = camera.capture_arrays(arrays, wait=False)
 
         # build the item to yield
-        item['metadata'] = metadata
-        item['metadata']['CameraModel'] = camera.camera_properties['Model']
+        item.metadata = metadata
+        metadata['CameraModel'] = camera_model
+        metadata['ImageSize'] = image_size
         
-        image_key = 'raw' if 'raw' in item else 'main'
-        item['metadata']['ImageSize'] = camera.camera_config[image_key]['size']
-        
-        for idx, array in enumerate(arrays):
-            image_format = camera.camera_config[array]['format']
-            image_dtype = image_dtypes[image_format]
+        for idx, (array, image_dtype, stream_info) in enumerate(array_info):
+            image = images[idx]
+            if image.dtype != image_dtype:
+                image = image.view(image_dtype)
             
-            item[array] = {
-                'image': images[idx].view(image_dtype),
-                'format': camera.camera_config[array]['format'],
-                'framesize': camera.camera_config[array]['framesize'],
-                'size': camera.camera_config[array]['size'],
-                'stride': camera.camera_config[array]['stride']
-            }
+            setattr(item, array, (image, stream_info))
 
         yield item
 
 
-def focus(pipe, camera):
+def apply_controls(pipe, camera):
+    set_controls = camera.set_controls
     
     # check if focus is supported
     mdata = camera.capture_metadata()
@@ -85,101 +159,122 @@ def focus(pipe, camera):
     # start in autofocus mode and trigger a focus run
     if can_focus:
         ctrls = {
-            'AfMode': controls.AfModeEnum.Auto,
-            'AfTrigger': controls.AfTriggerEnum.Start
+            'AfMode': _AF_AUTO,
+            'AfTrigger': _AF_START
         }
-        camera.set_controls(ctrls)
+        set_controls(ctrls)
     
     af_enable = can_focus
+    awb_enable = True
+    ae_enable = True
+    last_ctrls = None
     
     for item in pipe:
-        ctrls = item['controls']
+        ctrls_get = item.controls.get
         local_ctrls = {}
-        if (ctrl_af_enable := ctrls.get('AfEnable', None)) is not None:
-            af_enable = ctrl_af_enable
-            if af_enable:
-                local_ctrls['AfMode'] = controls.AfModeEnum.Auto
-                local_ctrls['AfTrigger'] = controls.AfTriggerEnum.Start
-            else:
-                af_enable = False
-                local_ctrls['AfMode'] = controls.AfModeEnum.Manual
         
-        if ctrls.get('AfTrigger', False):
-            local_ctrls['AfTrigger'] = controls.AfTriggerEnum.Start
+        # the whitebalance and exposure controls go straight to the camera
+        for k in _CAMERA_KEYS:
+            if (v := ctrls_get(k, _SENTINEL)) is not _SENTINEL:
+                local_ctrls[k] = v
         
-        if (lp := ctrls.get('LensPosition', None)) is not None:
-            af_enable = False
-            local_ctrls['AfMode'] = controls.AfModeEnum.Manual
-            local_ctrls['LensPosition'] = lp
+        if (gains := local_ctrls.get('ColourGains', None)) is not None:
+            # json turns the tuple into a list
+            local_ctrls['ColourGains'] = tuple(gains)
         
-        if can_focus and len(local_ctrls):
-            camera.set_controls(local_ctrls)
-        
-        # insert the AfEnable item into the metadata
+        # the focus controls map onto the autofocus mode and trigger
         if can_focus:
-            metadata = item['metadata']
-            metadata['AfEnable'] = af_enable
+            if (ctrl_af_enable := ctrls_get('AfEnable', None)) is not None:
+                af_enable = ctrl_af_enable
+                if af_enable:
+                    local_ctrls['AfMode'] = _AF_AUTO
+                    local_ctrls['AfTrigger'] = _AF_START
+                else:
+                    local_ctrls['AfMode'] = _AF_MANUAL
+            
+            if ctrls_get('AfTrigger', False):
+                local_ctrls['AfTrigger'] = _AF_START
+            
+            if (lp := ctrls_get('LensPosition', None)) is not None:
+                af_enable = False
+                local_ctrls['AfMode'] = _AF_MANUAL
+                local_ctrls['LensPosition'] = lp
         
-        yield item
-
-
-def whitebalance(pipe, camera):
-    local_keys = {'AwbEnable', 'ColourGains'}
-    
-    awb_enable = True
-    
-    for item in pipe:
-        # set the controls
-        ctrls = item['controls']
-        local_ctrls = { k: ctrls[k] for k in local_keys & ctrls.keys() }
+        # set everything in one call, skipping repeats of the last controls
+        #   but always sending a trigger
         if len(local_ctrls):
-            camera.set_controls(local_ctrls)
-
-        # insert the AeEnable item into the metadata
-        metadata = item['metadata']
+            if 'AfTrigger' in local_ctrls or local_ctrls != last_ctrls:
+                set_controls(local_ctrls)
+                last_ctrls = local_ctrls
+        
+        # insert the enable states into the metadata
+        metadata = item.metadata
+        metadata['AeEnable'] = ae_enable = local_ctrls.get('AeEnable', ae_enable)
         metadata['AwbEnable'] = awb_enable = local_ctrls.get('AwbEnable', awb_enable)
+        if can_focus:
+            metadata['AfEnable'] = af_enable
         
         yield item
 
+
+def jpeg_encoder(pipe):
     
-def exposure(pipe, camera):
-    # the controls managed in this operator
-    local_keys = {'AeEnable', 'AnalogueGain', 'ExposureTime'}
+    # frames are streamed, so favour encode speed over file size: baseline
+    #   jpeg with the default huffman tables and 4:2:0 chroma subsampling
     
-    ae_enable = True
+    # the PIL fallback encodes into the same buffer every frame
+    jpeg = io.BytesIO()
     
     for item in pipe:
-        # set the controls
-        ctrls = item['controls']
-        local_ctrls = { k: ctrls[k] for k in local_keys & ctrls.keys() }
-        if len(local_ctrls):
-            camera.set_controls(local_ctrls)
-
-        # insert the AeEnable item into the metadata
-        metadata = item['metadata']
-        metadata['AeEnable'] = ae_enable = local_ctrls.get('AeEnable', ae_enable)
+        image, _ = item.stream
+
+        if simplejpeg is not None:
+            # the 'BGR888' format from picamera2 is actually RGB in memory
+            item.jpeg = simplejpeg.encode_jpeg(
+                np.ascontiguousarray(image), 
+                quality=95, 
+                colorspace='RGB', 
+                colorsubsampling='420', 
+                fastdct=True
+            )
+        else:
+            image = Image.fromarray(image)
+            
+            jpeg.seek(0, io.SEEK_SET)
+            jpeg.truncate(0)
+            image.save(jpeg, format='jpeg', quality=95, optimize=False, progressive=False)
+            
+            # the buffer is reused, so the item needs its own copy
+            item.jpeg = jpeg.getvalue()
         
         yield item
 
 
-def jpeg_encoder(pipe):
-    
+def publisher(pipe, pub_sock):
+
     for item in pipe:
-        image_key = 'raw' if 'raw' in item else 'main'
-        image = item[image_key]['image']
+        idx = zmq.Frame(item.idx.to_bytes(8, 'little'), copy=False, track=False)
 
-        image = Image.fromarray(image)
-        
-        jpeg = io.BytesIO()
-        image.save(jpeg, format='jpeg', quality=95)
-        jpeg.seek(0, io.SEEK_SET)
+        # send the published subset of the metadata
+        metadata = item.metadata
+        pub_meta = { k: metadata[k] for k in _PUBLISH_KEYS if k in metadata }
         
-        item['jpeg'] = jpeg.getvalue()
+        metajs = codec.dumps(pub_meta)
+        metajs = zmq.Frame(metajs, copy=False, track=False)
+
+        # the jpeg frame references the encoder's buffer directly and the item
+        #   keeps it alive until the next frame
+        jpeg = zmq.Frame(item.jpeg, copy=False, track=False)
         
+        # send the metadata and image together as a single message
+        pub_sock.send_multipart([PubSubCommands.FRAME, idx, metajs, jpeg])
+
         yield item
 
 
-def publisher(pipe, pub_sock, svr_socket):
+def api_updates(pipe, svr_socket):
+    
+    pack = ServerUpdates.STRUCT.pack
     
     exposure_time = 0
     analogue_gain = 0.0
@@ -188,58 +283,90 @@ def publisher(pipe, pub_sock, svr_socket):
     blue_gain = 0.0
 
     for item in pipe:
-        idx = item['idx']
-        idx = f"{idx}".encode('utf-8')
-
-        # take a copy of the metadata so we can change it without impacting
-        #   any other operators
-        metadata = item['metadata'].copy()
-
-        # remove and stats information from the metadata
-        for k in list(metadata.keys()):
-            if k.endswith('StatsOutput'):
-                del metadata[k]
-        
-        # send the metadata
-        metajs = json.dumps(metadata, separators=(',',':'))
-        pub_sock.send_multipart([PubSubCommands.METADATA, idx, metajs.encode('utf-8')], copy=False)
-
-        # send the jpeg image
-        jpeg = item['jpeg']
-        pub_sock.send_multipart([PubSubCommands.JPEGIMG, idx, jpeg], copy=False)
+        metadata = item.metadata
         
         # send updates to the api server
-        updates = {}
+        mask = 0
         
         if metadata['AnalogueGain'] != analogue_gain or metadata['ExposureTime'] != exposure_time:
-            analogue_gain = updates['AnalogueGain'] = metadata['AnalogueGain']
-            exposure_time = updates['ExposureTime'] = metadata['ExposureTime']
+            analogue_gain = metadata['AnalogueGain']
+            exposure_time = metadata['ExposureTime']
+            mask |= ServerUpdates.ANALOGUE_GAIN | ServerUpdates.EXPOSURE_TIME
         
         if lens_position != metadata.get('LensPosition', 0.0):
-            lens_position = updates['LensPosition'] = metadata['LensPosition']
+            lens_position = metadata['LensPosition']
+            mask |= ServerUpdates.LENS_POSITION
 
         cur_red_gain, cur_blue_gain = metadata.get('ColourGains', (0.0, 0.0))
         cur_red_gain = round(cur_red_gain, 2)
         cur_blue_gain = round(cur_blue_gain, 2)
         if red_gain != cur_red_gain:
-            red_gain = updates['RedGain'] = cur_red_gain
+            red_gain = cur_red_gain
+            mask |= ServerUpdates.RED_GAIN
         if blue_gain != cur_blue_gain:
-            blue_gain = updates['BlueGain'] = cur_blue_gain
+            blue_gain = cur_blue_gain
+            mask |= ServerUpdates.BLUE_GAIN
         
-        if len(updates):
-            svr_socket.send_pyobj(updates)
+        if mask:
+            svr_socket.send(pack(mask, analogue_gain, exposure_time, lens_position, red_gain, blue_gain), copy=False)
 
         yield item
 
 
+def threaded(pipe, *, maxsize=2):
+    # run the upstream operators in their own thread, handing items over through
+    #   a bounded queue. the encoder, opencv and zmq all release the GIL, so the
+    #   stages on either side of the queue overlap.
+    items = queue.Queue(maxsize=maxsize)
+    over = threading.Event()
+    done = object()
+    
+    def put(item):
+        # keep checking if the consumer has gone away while the queue is full
+        while not over.is_set():
+            try:
+                items.put(item, timeout=0.2)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def run():
+        try:
+            for item in pipe:
+                if not put(item):
+                    break
+            put(done)
+        except Exception as e:
+            put(e)
+        finally:
+            pipe.close()
+    
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    
+    try:
+        while (item := items.get()) is not done:
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        over.set()
+        thread.join()
+
+
 def fit_cropped(pipe, *, enabled):
 
     enabled = enabled
     set_crop_w = sys.maxsize
     set_crop_h = sys.maxsize
     
+    # the crop window only changes with the image or requested size
+    cached_key = None
+    cached_slice = None
+    
     for item in pipe:
-        controls = item['controls']
+        controls = item.controls
 
         # check for updates
         if (fmode := controls.get('FitMode', None)) is not None:
@@ -248,16 +375,23 @@ def fit_cropped(pipe, *, enabled):
         set_crop_h = controls.get('Height', set_crop_h)
 
         if enabled:
-            image_key = 'raw' if 'raw' in item else 'main'
-            image = item[image_key]['image']
-            image_h, image_w, _ = image.shape
-        
-            crop_w, crop_h = min(image_w, set_crop_w), min(image_h, set_crop_h)
-        
-            if crop_w < image_w or crop_h < image_h:
-                x0, x1 = int((image_w - crop_w)/2), int((image_w + crop_w)/2)
-                y0, y1 = int((image_h - crop_h)/2), int((image_h + crop_h)/2)
-                item[image_key]['image'] = image[y0:y1, x0:x1, :]
+            image, stream_info = item.stream
+            
+            key = (image.shape[0], image.shape[1], set_crop_w, set_crop_h)
+            if key != cached_key:
+                image_h, image_w = key[0], key[1]
+                crop_w, crop_h = min(image_w, set_crop_w), min(image_h, set_crop_h)
+                
+                cached_key = key
+                cached_slice = None
+                if crop_w < image_w or crop_h < image_h:
+                    x0, x1 = int((image_w - crop_w)/2), int((image_w + crop_w)/2)
+                    y0, y1 = int((image_h - crop_h)/2), int((image_h + crop_h)/2)
+                    cached_slice = (slice(y0, y1), slice(x0, x1))
+            
+            # slicing returns a view, so no image data is copied
+            if cached_slice is not None:
+                item.stream = (image[cached_slice], stream_info)
 
         yield item
 
@@ -270,8 +404,11 @@ def fit_scaled(pipe, *, enabled):
     set_scale_w = sys.maxsize
     set_scale_h = sys.maxsize
     
+    # reuse the output buffer while the scaled size doesn't change
+    dst = None
+    
     for item in pipe:
-        controls = item['controls']
+        controls = item.controls
 
         # check for updates
         if (fmode := controls.get('FitMode', None)) is not None:
@@ -280,14 +417,20 @@ def fit_scaled(pipe, *, enabled):
         set_scale_h = controls.get('Height', set_scale_h)
 
         if enabled:
-            image_key = 'raw' if 'raw' in item else 'main'
-            image = item[image_key]['image']
+            image, stream_info = item.stream
             image_h, image_w, _ = image.shape
         
             scale_w, scale_h = min(image_w, set_scale_w), min(image_h, set_scale_h)
             if scale_w < image_w or scale_h < image_h:
                 # preserve image aspect ratio
                 scale = min(scale_w/image_w, scale_h/image_h)
-                item[image_key]['image'] = cv2.resize(image, None, fx=scale, fy=scale)
+                new_w, new_h = round(image_w*scale), round(image_h*scale)
+                
+                if dst is None or dst.shape != (new_h, new_w, image.shape[2]) or dst.dtype != image.dtype:
+                    dst = np.empty((new_h, new_w, image.shape[2]), dtype=image.dtype)
+                
+                # only ever downscaling here, so INTER_AREA is the better choice
+                image = cv2.resize(image, (new_w, new_h), dst=dst, interpolation=cv2.INTER_AREA)
+                item.stream = (image, stream_info)
 
         yield item
@@ -20,60 +20,57 @@ bayer_scale = {
     'SRGGB16': 1.0,
 }
 
-def raw_gamma8(pipe):
-    
-    scale = 255.0 / np.power(65535, 1.0/2.2)
+def raw_demosaic(pipe):
 
     for item in pipe:
-        image = item['raw']['image']
-        image_format = item['raw']['format']
+        image, stream_info = item.raw
+        image_format = stream_info.format
         
         # scale the image up to the top part of the 16bit word
         image = image * bayer_scale[image_format]
 
         # subtract the sensor black levels
-        black_level = item['metadata']['SensorBlackLevels'][0]
+        black_level = item.metadata['SensorBlackLevels'][0]
         image = np.maximum(image, black_level) - black_level
 
         # demosaic the image
         bayer_code = bayer_codes[image_format]
         image = cv2.demosaicing(image.astype(np.uint16), bayer_code)
         
-        # apply the gamma encoding and convert to 8bit range
-        image = np.power(image, 1.0/2.2) * scale
-        image = image.astype(np.uint8)
-
         # store the image back in the item
-        item['raw']['image'] = image
+        item.raw = (image, stream_info)
 
         yield item
 
 
-def raw_linear8(pipe):
+def raw_gamma8(pipe):
     
-    scale = 255.0 / 65535.0
+    # the demosaiced image is 16bit, so precompute the gamma encoding for
+    #   every possible value once and apply it as a lookup
+    scale = 255.0 / np.power(65535, 1.0/2.2)
+    gamma_lut = (np.power(np.arange(65536), 1.0/2.2) * scale).astype(np.uint8)
 
     for item in pipe:
-        image = item['raw']['image']
-        image_format = item['raw']['format']
+        image, stream_info = item.raw
+        
+        # apply the gamma encoding and convert to 8bit range
+        image = gamma_lut[image]
 
-        # scale the image up to the top part of the 16bit word
-        image = image * bayer_scale[image_format]
+        # store the image back in the item
+        item.raw = (image, stream_info)
 
-        # subtract the sensor black levels
-        black_level = item['metadata']['SensorBlackLevels'][0]
-        image = np.maximum(image, black_level) - black_level
+        yield item
 
-        # demosaic the image
-        bayer_code = bayer_codes[image_format]
-        image = cv2.demosaicing(image.astype(np.uint16), bayer_code)
 
-        # apply the gamma encoding and convert to 8bit range
-        image = image * scale
-        image = image.astype(np.uint8)
+def raw_linear8(pipe):
+    
+    for item in pipe:
+        image, stream_info = item.raw
+
+        # convert to 8bit range by keeping the top byte of the 16bit word
+        image = np.right_shift(image, 8, out=np.empty(image.shape, dtype=np.uint8), casting='unsafe')
 
         # store the image back in the item
-        item['raw']['image'] = image
+        item.raw = (image, stream_info)
 
         yield item
-
@@ -3,9 +3,10 @@ import threading
 import zmq
 
 from .operators import control, capture, jpeg_encoder, publisher
-from .operators import focus, exposure, whitebalance
+from .operators import api_updates, threaded
+from .operators import apply_controls
 from .operators import fit_scaled, fit_cropped
-from .operators_raw import raw_linear8, raw_gamma8
+from .operators_raw import raw_demosaic, raw_linear8, raw_gamma8
 
 
 class PubServer(threading.Thread):
@@ -22,9 +23,9 @@ class PubServer(threading.Thread):
         self.ae_enabled = ae_enabled
         self.dtype = dtype
         
-        self.arrays = arrays = ["main"]
-        if self.dtype != 'rgb':
-            self.arrays.append("raw")
+        # only capture the stream that gets encoded - the ISP demosaics 'main'
+        #   in hardware, the raw stream is demosaiced by the raw operators
+        self.arrays = ["main"] if self.dtype == 'rgb' else ["raw"]
         self.camera = camera
         
     def run(self):
@@ -34,9 +35,14 @@ class PubServer(threading.Thread):
 
         pipe = control(self.svr_sock)
         pipe = capture(pipe, self.camera, self.arrays)
-        pipe = focus(pipe, self.camera)
-        pipe = exposure(pipe, self.camera)
-        pipe = whitebalance(pipe, self.camera)
+        pipe = apply_controls(pipe, self.camera)
+        pipe = api_updates(pipe, self.svr_sock)
+        
+        # the svr_sock is only used before this point, so it stays on one thread
+        pipe = threaded(pipe)
+        
+        if self.dtype != 'rgb':
+            pipe = raw_demosaic(pipe)
         
         if self.dtype == 'rl8':
             pipe = raw_linear8(pipe)
@@ -46,11 +52,17 @@ class PubServer(threading.Thread):
         pipe = fit_cropped(pipe, enabled=False)
         pipe = fit_scaled(pipe, enabled=True)
         pipe = jpeg_encoder(pipe)
-        pipe = publisher(pipe, self.pub_sock, self.svr_sock)
+        
+        # fit_scaled reuses its output buffer, so the encoder must stay on its thread
+        pipe = threaded(pipe)
+        pipe = publisher(pipe, self.pub_sock)
         
         for item in pipe:
-            if item['controls'].get('Over', False):
+            if item.controls.get('Over', False):
                 break
+        
+        # shuts down the pipeline threads
+        pipe.close()
 
         print("pub_server: finish")
 
@@ -3,3 +3,5 @@
 sudo apt install -y python3-libcamera python3-picamera2 
 sudo apt install -y python3-opencv python3-numpy python3-pil
 sudo apt install -y python3-zmq python3-psutil
+sudo apt install -y python3-simplejpeg
+sudo apt install -y python3-orjson